@@ -7,7 +7,7 @@ import asyncio
 import httpx
 import json
 
-async def test_remediation_api():
+async def test_remediation_api(client: httpx.AsyncClient):
     """Test the remediation API with the example from the requirements."""
     
     # Example request from the requirements
@@ -25,27 +25,26 @@ async def test_remediation_api():
     print("=" * 50)
     
     try:
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            response = await client.post(
-                "http://localhost:8000/api/remediation",
-                json=request_data,
-                headers={"Content-Type": "application/json"}
-            )
+        response = await client.post(
+            "http://localhost:8000/api/remediation",
+            json=request_data,
+            headers={"Content-Type": "application/json"}
+        )
+        
+        if response.status_code == 200:
+            result = response.json()
+            print("✅ API Response (Success):")
+            print(json.dumps(result, indent=2))
+            return True
+        else:
+            print(f"❌ API Error (Status {response.status_code}):")
+            try:
+                error_detail = response.json()
+                print(json.dumps(error_detail, indent=2))
+            except:
+                print(response.text)
+            return False
             
-            if response.status_code == 200:
-                result = response.json()
-                print("✅ API Response (Success):")
-                print(json.dumps(result, indent=2))
-                return True
-            else:
-                print(f"❌ API Error (Status {response.status_code}):")
-                try:
-                    error_detail = response.json()
-                    print(json.dumps(error_detail, indent=2))
-                except:
-                    print(response.text)
-                return False
-                
     except httpx.ConnectError:
         print("❌ Connection failed - make sure the API server is running at http://localhost:8000")
         print("   Start the server with: python main.py")
@@ -54,23 +53,22 @@ async def test_remediation_api():
         print(f"❌ Unexpected error: {e}")
         return False
 
-async def test_health_endpoint():
+async def test_health_endpoint(client: httpx.AsyncClient):
     """Test the health check endpoint."""
     print("\n🔍 Testing health endpoint...")
     
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            response = await client.get("http://localhost:8000/health")
+        response = await client.get("http://localhost:8000/health", timeout=10.0)
+        
+        if response.status_code == 200:
+            result = response.json()
+            print("✅ Health check passed:")
+            print(json.dumps(result, indent=2))
+            return True
+        else:
+            print(f"❌ Health check failed (Status {response.status_code})")
+            return False
             
-            if response.status_code == 200:
-                result = response.json()
-                print("✅ Health check passed:")
-                print(json.dumps(result, indent=2))
-                return True
-            else:
-                print(f"❌ Health check failed (Status {response.status_code})")
-                return False
-                
     except httpx.ConnectError:
         print("❌ Connection failed - server not running")
         return False
@@ -83,16 +81,18 @@ async def main():
     print("📡 Code Remediation API Test Suite")
     print("=" * 60)
     
-    # Test health endpoint first
-    health_ok = await test_health_endpoint()
-    
-    if not health_ok:
-        print("\n❌ Health check failed. Please start the server first:")
-        print("   python main.py")
-        return 1
-    
-    # Test the main remediation endpoint
-    remediation_ok = await test_remediation_api()
+    # Share one connection across both checks
+    async with httpx.AsyncClient(timeout=120.0) as client:
+        # Test health endpoint first
+        health_ok = await test_health_endpoint(client)
+        
+        if not health_ok:
+            print("\n❌ Health check failed. Please start the server first:")
+            print("   python main.py")
+            return 1
+        
+        # Test the main remediation endpoint
+        remediation_ok = await test_remediation_api(client)
     
     print("\n" + "=" * 60)
     if health_ok and remediation_ok:
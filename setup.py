@@ -1,70 +1,9 @@
-"""Setup script for Code Remediation Service"""
+"""Setup script for Code Remediation Service
 
-from setuptools import setup, find_packages
-from pathlib import Path
+Package metadata and dependencies are declared in pyproject.toml; this shim
+only keeps legacy ``python setup.py`` invocations working.
+"""
 
-# Read the README file
-this_directory = Path(__file__).parent
-long_description = (this_directory / "README.md").read_text()
+from setuptools import setup
 
-# Read requirements
-requirements = []
-with open("requirements.txt") as f:
-    requirements = [line.strip() for line in f if line.strip() and not line.startswith("#")]
-
-# Development requirements
-dev_requirements = [
-    "pytest>=7.0.0",
-    "pytest-asyncio>=0.21.0",
-    "pytest-cov>=4.0.0",
-    "black>=23.0.0",
-    "flake8>=6.0.0",
-    "mypy>=1.0.0",
-    "isort>=5.12.0",
-    "pre-commit>=3.0.0",
-]
-
-setup(
-    name="code-remediation-service",
-    version="1.0.0",
-    author="Code Remediation Team",
-    author_email="team@remediation.dev",
-    description="AI-powered code remediation with security validation",
-    long_description=long_description,
-    long_description_content_type="text/markdown",
-    url="https://github.com/your-org/code-remediation-service",
-    package_dir={"": "src"},
-    packages=find_packages(where="src"),
-    classifiers=[
-        "Development Status :: 4 - Beta",
-        "Intended Audience :: Developers",
-        "License :: OSI Approved :: MIT License",
-        "Operating System :: OS Independent",
-        "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.8",
-        "Programming Language :: Python :: 3.9",
-        "Programming Language :: Python :: 3.10",
-        "Programming Language :: Python :: 3.11",
-        "Topic :: Software Development :: Quality Assurance",
-        "Topic :: Security",
-    ],
-    python_requires=">=3.8",
-    install_requires=requirements,
-    extras_require={
-        "dev": dev_requirements,
-        "test": [
-            "pytest>=7.0.0",
-            "pytest-asyncio>=0.21.0",
-            "pytest-cov>=4.0.0",
-        ],
-    },
-    entry_points={
-        "console_scripts": [
-            "remediation-server=remediation.main:main",
-        ],
-    },
-    include_package_data=True,
-    package_data={
-        "remediation": ["*.toml", "*.yaml", "*.yml"],
-    },
-)
+setup()
@@ -1,8 +1,10 @@
 """API routes for code remediation service"""
 
 from fastapi import APIRouter, HTTPException, Depends
+import asyncio
 import logging
-from typing import List
+from functools import lru_cache
+from typing import Final, List
 
 from ..models.schemas import (
     RemediationRequest, 
@@ -10,24 +12,57 @@ from ..models.schemas import (
     HealthResponse,
     ErrorResponse
 )
-from ..services.ollama_client import OllamaClient
+from ..services.ollama_client import OllamaClient, OllamaConnectionError, build_messages
 from ..services.vorpal_scanner import VorpalScanner
 from ..config.settings import settings
+from ..utils import get_file_extension
 
 logger = logging.getLogger(__name__)
 
 # Create API router
 router = APIRouter()
 
-# Dependency injection for services
+# System prompt for the AI model
+_SYSTEM_PROMPT: Final[str] = """You are a security remediation expert. Your task is to provide ONLY secure code snippets that fix the specified vulnerability. 
+
+Rules:
+1. Respond with ONLY the code snippet - no explanations, no markdown formatting
+2. The code must be syntactically correct and secure
+3. Use the exact programming language specified in the request
+4. Focus specifically on fixing the vulnerability described
+
+The code should demonstrate the secure way to implement the functionality."""
+
+# Initial user prompt, filled in from the remediation request
+_USER_PROMPT_TEMPLATE: Final[str] = """
+Language: {language}
+Rule: {rule_name}
+Description: {description}
+Remediation Advice: {remediation_advice}
+
+Provide a secure code snippet that fixes this vulnerability.
+"""
+
+# User prompt for attempts after the scanner found vulnerabilities
+_RETRY_PROMPT: Final[str] = "Based on the previous security analysis feedback, please provide an improved and more secure version."
+
+# Dependency injection for services - one shared instance per process
+@lru_cache(maxsize=1)
 def get_ollama_client() -> OllamaClient:
     """Get Ollama client instance"""
     return OllamaClient()
 
+@lru_cache(maxsize=1)
 def get_vorpal_scanner() -> VorpalScanner:
     """Get Vorpal scanner instance"""
     return VorpalScanner()
 
+async def close_services() -> None:
+    """Release the shared service instances' resources"""
+    if get_ollama_client.cache_info().currsize:
+        await get_ollama_client().aclose()
+        get_ollama_client.cache_clear()
+
 
 @router.post(
     "/api/remediation",
@@ -57,59 +92,42 @@ async def remediate_code(
     logger.info(f"Processing remediation request for {request.language} - {request.ruleName}")
     
     max_retries = settings.max_retries
-    conversation_history = []
+    # Rolling chat: system message followed by the recent assistant/Vorpal attempts
+    messages = build_messages(_SYSTEM_PROMPT)
     
     # Validate language
-    if request.language.lower() not in [lang.lower() for lang in settings.allowed_languages]:
+    if request.language.lower() not in settings.allowed_languages:
         raise HTTPException(
             status_code=400, 
-            detail=f"Unsupported language: {request.language}. Supported languages: {', '.join(settings.allowed_languages)}"
+            detail=f"Unsupported language: {request.language}. Supported languages: {', '.join(sorted(settings.allowed_languages))}"
         )
     
-    # Initial system prompt for the AI model
-    system_prompt = """You are a security remediation expert. Your task is to provide ONLY secure code snippets that fix the specified vulnerability. 
-
-Rules:
-1. Respond with ONLY the code snippet - no explanations, no markdown formatting
-2. The code must be syntactically correct and secure
-3. Use the exact programming language specified in the request
-4. Focus specifically on fixing the vulnerability described
-
-The code should demonstrate the secure way to implement the functionality."""
-
-    # Initial user prompt
-    user_prompt = f"""
-Language: {request.language}
-Rule: {request.ruleName}
-Description: {request.description}
-Remediation Advice: {request.remediationAdvice}
-
-Provide a secure code snippet that fixes this vulnerability.
-"""
+    user_prompt = _USER_PROMPT_TEMPLATE.format(
+        language=request.language,
+        rule_name=request.ruleName,
+        description=request.description,
+        remediation_advice=request.remediationAdvice
+    )
 
     for attempt in range(max_retries):
         try:
             logger.debug(f"Remediation attempt {attempt + 1}/{max_retries}")
             
             # Get remediation from Ollama using chat API
-            if attempt == 0:
-                # First attempt with original prompt
-                remediated_code = await ollama_client.generate_remediation(
-                    system_prompt=system_prompt,
-                    user_prompt=user_prompt,
-                    conversation_history=[]
-                )
+            history_length = len(messages) - 1
+            if not history_length:
+                # First attempt (or retry after a transient error) with original prompt
+                messages.append({"role": "user", "content": user_prompt})
             else:
                 # Subsequent attempts with full conversation history including Vorpal feedback
-                enhanced_user_prompt = "Based on the previous security analysis feedback, please provide an improved and more secure version."
-                
-                remediated_code = await ollama_client.generate_remediation(
-                    system_prompt=system_prompt,
-                    user_prompt=enhanced_user_prompt,
-                    conversation_history=conversation_history
-                )
-                
-                logger.debug(f"Retry attempt {attempt + 1} with {len(conversation_history)} messages in conversation history")
+                messages.append({"role": "user", "content": _RETRY_PROMPT})
+                logger.debug(f"Retry attempt {attempt + 1} with {history_length} messages in conversation history")
+            
+            try:
+                remediated_code = await ollama_client.chat(messages)
+            finally:
+                # The prompt is re-added for each attempt, only replies and feedback are kept
+                messages.pop()
             
             if not remediated_code.strip():
                 raise HTTPException(status_code=500, detail="Empty response from AI model")
@@ -118,24 +136,29 @@ Provide a secure code snippet that fixes this vulnerability.
             scan_result = await vorpal_scanner.scan_code(
                 code=remediated_code,
                 language=request.language,
-                filename=f"remediation.{_get_file_extension(request.language)}"
+                filename=f"remediation.{get_file_extension(request.language)}"
             )
             
             if scan_result.has_vulnerabilities():
                 # Add assistant's response and Vorpal analysis to conversation history
                 vulnerability_details = scan_result.get_vulnerability_summary()
                 # Add assistant's code attempt
-                conversation_history.append({
+                messages.append({
                     "role": "assistant", 
                     "content": remediated_code
                 })
                 
                 # Add Vorpal analysis result as a user message for better model understanding
-                conversation_history.append({
+                messages.append({
                     "role": "vorpal_results",
                     "content": f"The security scanner found these vulnerabilities in your code: {vulnerability_details}\n\nPlease fix these specific security issues and provide a corrected version."
                 })
                 
+                # Only keep the most recent attempts so retry prompts stay bounded
+                excess = len(messages) - 1 - settings.max_history_messages
+                if excess > 0:
+                    del messages[1:1 + excess]
+                
                 logger.warning(f"Attempt {attempt + 1} had vulnerabilities: {vulnerability_details}")
                 logger.debug(f"Added Vorpal analysis to conversation history: {vulnerability_details}")
                 
@@ -154,16 +177,15 @@ Provide a secure code snippet that fixes this vulnerability.
         except HTTPException:
             # Re-raise HTTP exceptions
             raise
-        except Exception as e:
+        except OllamaConnectionError as e:
+            # Transient network/timeout failure - retry without growing the conversation
             logger.error(f"Error in attempt {attempt + 1}: {e}")
             if attempt == max_retries - 1:
                 raise HTTPException(status_code=500, detail=f"Failed to generate remediation: {str(e)}")
-            # Add error to conversation history for context
-            conversation_history.append({
-                "role": "system",
-                "content": f"Error occurred in previous attempt: {str(e)}"
-            })
             continue
+        except Exception as e:
+            logger.error(f"Error in attempt {attempt + 1}: {e}")
+            raise HTTPException(status_code=500, detail=f"Failed to generate remediation: {str(e)}")
     
     raise HTTPException(status_code=500, detail="Unexpected error in remediation process")
 
@@ -172,31 +194,28 @@ Provide a secure code snippet that fixes this vulnerability.
     "/health",
     response_model=HealthResponse,
     summary="Health check",
-    description="Check if the service is healthy and all dependencies are available"
+    description="Check that the service is up; dependency status is logged but never fails the check"
 )
 async def health_check(
-    ollama_client: OllamaClient = Depends(get_ollama_client),
-    vorpal_scanner: VorpalScanner = Depends(get_vorpal_scanner)
+    ollama_client: OllamaClient = Depends(get_ollama_client)
 ) -> HealthResponse:
-    """Health check endpoint with dependency validation."""
+    """Liveness endpoint; Vorpal is only exercised by the readiness check."""
     
     try:
+        # A probe that raises counts as unhealthy
+        try:
+            ollama_healthy = await ollama_client.liveness()
+        except Exception as e:
+            logger.warning(f"Ollama health check raised: {e}")
+            ollama_healthy = False
+        
         # Check Ollama service
-        ollama_healthy = await ollama_client.health_check()
-        if not ollama_healthy:
+        if ollama_healthy is not True:
             logger.warning(f"Ollama service is not healthy at {settings.ollama_base_url}")
             logger.info("Make sure Ollama is running: ollama serve")
-            logger.info(f"Make sure model is installed: ollama pull {settings.ollama_model}")
         else:
             logger.info("Ollama service is healthy")
         
-        # Check Vorpal scanner
-        vorpal_healthy = await vorpal_scanner.health_check()
-        if not vorpal_healthy:
-            logger.warning("Vorpal scanner is not healthy")
-        else:
-            logger.info("Vorpal scanner is healthy")
-        
         # Service is healthy if basic functionality works
         # Dependencies being down is logged but doesn't fail health check
         return HealthResponse(status="healthy")
@@ -206,14 +225,35 @@ async def health_check(
         raise HTTPException(status_code=503, detail="Service unavailable")
 
 
-def _get_file_extension(language: str) -> str:
-    """Get appropriate file extension for the language."""
-    extensions = {
-        "python": "py",
-        "javascript": "js",
-        "java": "java",
-        "go": "go",
-        "csharp": "cs",
-        "c#": "cs"
-    }
-    return extensions.get(language.lower(), "txt")
+@router.get(
+    "/health/ready",
+    response_model=HealthResponse,
+    responses={
+        200: {"model": HealthResponse},
+        503: {"model": ErrorResponse, "description": "A dependency is not ready"}
+    },
+    summary="Readiness check",
+    description="Check that Ollama serves the configured model and the Vorpal scanner runs"
+)
+async def readiness_check(
+    ollama_client: OllamaClient = Depends(get_ollama_client),
+    vorpal_scanner: VorpalScanner = Depends(get_vorpal_scanner)
+) -> HealthResponse:
+    """Readiness endpoint that fails while a dependency cannot serve requests."""
+    
+    ollama_ready, vorpal_ready = await asyncio.gather(
+        ollama_client.readiness(),
+        vorpal_scanner.health_check(),
+        return_exceptions=True
+    )
+    
+    if ollama_ready is not True:
+        logger.warning(f"Ollama is not ready: {ollama_ready}")
+        logger.info(f"Make sure model is installed: ollama pull {settings.ollama_model}")
+    if vorpal_ready is not True:
+        logger.warning(f"Vorpal scanner is not ready: {vorpal_ready}")
+    
+    if ollama_ready is not True or vorpal_ready is not True:
+        raise HTTPException(status_code=503, detail="Service not ready")
+    
+    return HealthResponse(status="ready")
@@ -1,12 +1,33 @@
 """Application configuration settings"""
 
 import os
+from functools import cached_property, lru_cache
 from pathlib import Path
 from typing import Optional
 import re
 
-from pydantic_settings import BaseSettings
-from pydantic import validator
+from pydantic_settings import BaseSettings, SettingsConfigDict
+from pydantic import field_validator, model_validator
+
+
+# Host formats accepted for the Ollama service
+_LOCAL_HOSTS = frozenset({"localhost", "127.0.0.1"})
+_IP_RE = re.compile(r"^(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)$")
+_DOMAIN_RE = re.compile(r"^(?:[a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?\.)+[a-zA-Z]{2,}$")
+_SERVICE_NAME_RE = re.compile(r"^[a-zA-Z0-9](?:[a-zA-Z0-9-_]{0,61}[a-zA-Z0-9])?$")
+
+# Bundled scanner used for local development, outside the container
+_PROJECT_ROOT = Path(__file__).resolve().parents[3]
+_LOCAL_VORPAL_PATH = _PROJECT_ROOT / "resources" / "vorpal_cli_darwin_arm64"
+_LOCAL_VORPAL_STR = str(_LOCAL_VORPAL_PATH)
+
+
+@lru_cache(maxsize=8)
+def _resolve_vorpal_path(configured_path: str) -> str:
+    """Fallback to the bundled scanner if the configured path doesn't exist"""
+    if not os.path.exists(configured_path) and os.path.exists(_LOCAL_VORPAL_STR):
+        return _LOCAL_VORPAL_STR
+    return configured_path
 
 
 class Settings(BaseSettings):
@@ -18,6 +39,7 @@ class Settings(BaseSettings):
     host: str = "0.0.0.0"
     port: int = 8000
     debug: bool = False
+    cors_origins: list[str] = []  # Browser origins allowed to call the API; empty disables CORS
     
     # Ollama Configuration (Local Server)
     ollama_host: str = "localhost"  # Changed to localhost for local usage
@@ -28,52 +50,61 @@ class Settings(BaseSettings):
     # Vorpal Scanner Configuration
     vorpal_path: str = "/usr/local/bin/vorpal"  # Default container path
     max_retries: int = 5
+    max_history_messages: int = 4  # Conversation messages kept between retries
     
     # Security
-    allowed_languages: list[str] = ["python", "javascript", "java", "go", "csharp", "c#"]
+    allowed_languages: frozenset[str] = frozenset({"python", "javascript", "java", "go", "csharp", "c#"})
     
-    class Config:
-        env_file = ".env"
-        env_file_encoding = "utf-8"
-        case_sensitive = False
+    model_config = SettingsConfigDict(
+        env_file=".env",
+        env_file_encoding="utf-8",
+        case_sensitive=False,
         # Allow environment variables with REMEDIATION_ prefix
-        env_prefix = "REMEDIATION_"
-
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        # Fallback to local development path if container path doesn't exist
-        if not os.path.exists(self.vorpal_path):
-            project_root = Path(__file__).parent.parent.parent.parent
-            local_path = project_root / "resources" / "vorpal_cli_darwin_arm64"
-            if local_path.exists():
-                self.vorpal_path = str(local_path)
-
-    @validator("ollama_host")
+        env_prefix="REMEDIATION_",
+    )
+
+    @model_validator(mode="after")
+    def resolve_vorpal_path(self) -> "Settings":
+        """Fallback to local development path if container path doesn't exist"""
+        self.vorpal_path = _resolve_vorpal_path(self.vorpal_path)
+        return self
+
+    @field_validator("ollama_host")
+    @classmethod
     def validate_ollama_host(cls, v: str) -> str:
         """Validate Ollama host format"""
         # Allow localhost, IP addresses, domain names, and Docker service names
-        ip_pattern = re.compile(r"^(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)$")
-        domain_pattern = re.compile(r"^(?:[a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?\.)+[a-zA-Z]{2,}$")
-        service_name_pattern = re.compile(r"^[a-zA-Z0-9](?:[a-zA-Z0-9-_]{0,61}[a-zA-Z0-9])?$")
-        
-        if v in ["localhost", "127.0.0.1"]:
+        if v in _LOCAL_HOSTS:
             return v
-        if ip_pattern.match(v) or domain_pattern.match(v) or service_name_pattern.match(v):
+        if _IP_RE.match(v) or _DOMAIN_RE.match(v) or _SERVICE_NAME_RE.match(v):
             return v
         raise ValueError("Invalid host format. Must be localhost, IP address, domain name, or service name")
 
-    @validator("ollama_port")
+    @field_validator("allowed_languages")
+    @classmethod
+    def normalize_allowed_languages(cls, v: frozenset[str]) -> frozenset[str]:
+        """Lower-case allowed languages for case-insensitive membership checks"""
+        return frozenset(lang.lower() for lang in v)
+
+    @field_validator("ollama_port")
+    @classmethod
     def validate_ollama_port(cls, v: int) -> int:
         """Validate Ollama port number"""
         if not 1 <= v <= 65535:
             raise ValueError("Port must be between 1 and 65535")
         return v
 
-    @property
+    @cached_property
     def ollama_base_url(self) -> str:
         """Get the full Ollama base URL"""
         return f"http://{self.ollama_host}:{self.ollama_port}"
 
 
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """Get the cached application settings instance"""
+    return Settings()
+
+
 # Global settings instance
-settings = Settings()
+settings = get_settings()
@@ -1,28 +1,90 @@
 """Main application entry point"""
 
+import atexit
 import logging
 import sys
+from contextlib import asynccontextmanager
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
+from queue import SimpleQueue
+from typing import AsyncIterator
 
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
-from .api.routes import router
+from .api.routes import close_services, router
 from .config.settings import settings
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[
+_LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+
+def configure_logging() -> QueueListener:
+    """
+    Route log records through an in-memory queue drained by one background listener.
+    
+    Records are written to stdout and app.log off the request path. The call is
+    idempotent: when this file is imported under several names (uvicorn's reload
+    child runs it as __mp_main__ and then imports src.remediation.main), later
+    calls reuse the queue handler already on the root logger and its listener.
+    
+    Returns:
+        The running listener, which is stopped once at interpreter exit
+    """
+    root = logging.getLogger()
+    for handler in root.handlers:
+        listener = getattr(handler, "listener", None)
+        if isinstance(handler, QueueHandler) and isinstance(listener, QueueListener):
+            return listener
+    
+    log_queue: SimpleQueue = SimpleQueue()
+    handler = QueueHandler(log_queue)
+    handler.setFormatter(logging.Formatter(_LOG_FORMAT))
+    handler.listener = QueueListener(
+        log_queue,
         logging.StreamHandler(sys.stdout),
         logging.FileHandler("app.log")
-    ]
-)
+    )
+    root.addHandler(handler)
+    root.setLevel(logging.INFO)
+    
+    handler.listener.start()
+    # Stopping drains records still queued at shutdown
+    atexit.register(handler.listener.stop)
+    return handler.listener
+
+
+_log_listener = configure_logging()
 
 logger = logging.getLogger(__name__)
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """Application startup and shutdown"""
+    logger.info(f"Starting {settings.app_name} v{settings.app_version}")
+    logger.info(f"API server: http://{settings.host}:{settings.port}")
+    logger.info("=" * 50)
+    logger.info("LOCAL OLLAMA CONFIGURATION:")
+    logger.info(f"  Endpoint: {settings.ollama_base_url}")
+    logger.info(f"  Model: {settings.ollama_model}")
+    logger.info(f"  Timeout: {settings.ollama_timeout}s")
+    logger.info("=" * 50)
+    logger.info(f"Vorpal path: {settings.vorpal_path}")
+    logger.info(f"Max retries: {settings.max_retries}")
+    logger.info(f"Supported languages: {', '.join(sorted(settings.allowed_languages))}")
+    logger.info("=" * 50)
+    logger.info("SETUP CHECKLIST FOR LOCAL OLLAMA:")
+    logger.info("  1. Start Ollama: ollama serve")
+    logger.info(f"  2. Install model: ollama pull {settings.ollama_model}")
+    logger.info("  3. Test health: curl -X GET http://localhost:8000/health")
+    logger.info("=" * 50)
+    
+    yield
+    
+    logger.info("Shutting down Code Remediation Service")
+    await close_services()
+
+
 def create_app() -> FastAPI:
     """Create and configure the FastAPI application"""
     
@@ -32,47 +94,23 @@ def create_app() -> FastAPI:
         description="AI-powered code remediation with security validation",
         docs_url="/docs",
         redoc_url="/redoc",
-        openapi_url="/openapi.json"
+        openapi_url="/openapi.json",
+        lifespan=lifespan
     )
     
-    # Add CORS middleware
-    app.add_middleware(
-        CORSMiddleware,
-        allow_origins=["*"],
-        allow_credentials=True,
-        allow_methods=["*"],
-        allow_headers=["*"],
-    )
+    # Add CORS middleware only when browser clients are configured
+    if settings.cors_origins:
+        app.add_middleware(
+            CORSMiddleware,
+            allow_origins=settings.cors_origins,
+            allow_credentials=False,
+            allow_methods=["GET", "POST"],
+            allow_headers=["Content-Type"],
+        )
     
     # Include API routes
     app.include_router(router)
     
-    @app.on_event("startup")
-    async def startup_event():
-        """Application startup event"""
-        logger.info(f"Starting {settings.app_name} v{settings.app_version}")
-        logger.info(f"API server: http://{settings.host}:{settings.port}")
-        logger.info("=" * 50)
-        logger.info("LOCAL OLLAMA CONFIGURATION:")
-        logger.info(f"  Endpoint: {settings.ollama_base_url}")
-        logger.info(f"  Model: {settings.ollama_model}")
-        logger.info(f"  Timeout: {settings.ollama_timeout}s")
-        logger.info("=" * 50)
-        logger.info(f"Vorpal path: {settings.vorpal_path}")
-        logger.info(f"Max retries: {settings.max_retries}")
-        logger.info(f"Supported languages: {', '.join(settings.allowed_languages)}")
-        logger.info("=" * 50)
-        logger.info("SETUP CHECKLIST FOR LOCAL OLLAMA:")
-        logger.info("  1. Start Ollama: ollama serve")
-        logger.info(f"  2. Install model: ollama pull {settings.ollama_model}")
-        logger.info("  3. Test health: curl -X GET http://localhost:8000/health")
-        logger.info("=" * 50)
-    
-    @app.on_event("shutdown")
-    async def shutdown_event():
-        """Application shutdown event"""
-        logger.info("Shutting down Code Remediation Service")
-    
     return app
 
 
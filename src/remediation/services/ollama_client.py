@@ -1,22 +1,78 @@
 """Ollama AI service client for code remediation"""
 
 import httpx
-import json
+import orjson
+from functools import cached_property
 from typing import Optional
 import asyncio
 import logging
+import re
+import time
 
-from ..config.settings import settings
+from ..config.settings import get_settings
 
 logger = logging.getLogger(__name__)
 
+# Body of the first fenced markdown code block in a response
+_FENCE_RE = re.compile(r"```[a-zA-Z0-9_+#-]*[ \t]*\n(.*?)\n[ \t]*```", re.DOTALL)
+
+# Stray fence markers and explanatory lines the model tends to add around the code
+_CLEAN_LINE_RE = re.compile(
+    r"^[ \t]*(?:```|Here|This|The|Note:|Remember:|Example:)[^\n]*(?:\n|\Z)",
+    re.MULTILINE
+)
+
+
+class OllamaConnectionError(RuntimeError):
+    """Raised when the Ollama service cannot be reached or does not respond in time."""
+
+
+def build_messages(system_prompt: str) -> list:
+    """Start a chat message list that callers extend turn by turn."""
+    return [{"role": "system", "content": system_prompt}]
+
 
 class OllamaClient:
     """Client for communicating with Ollama AI service."""
     
+    # Sampling options sent with every remediation request
+    _OPTIONS = {
+        "temperature": 0.1,  # Low temperature for more deterministic output
+        "top_p": 0.9,
+        "top_k": 40,
+        "num_predict": 1000,  # Limit response length
+    }
+    
+    # Seconds a successful model availability check stays valid
+    _MODEL_CHECK_TTL = 300.0
+    
     def __init__(self, base_url: Optional[str] = None, model: Optional[str] = None):
-        self.base_url = base_url or settings.ollama_base_url
-        self.model = model or settings.ollama_model
+        app_settings = get_settings()
+        self.base_url = base_url or app_settings.ollama_base_url
+        self.model = model or app_settings.ollama_model
+        self.timeout = app_settings.ollama_timeout
+        # Chat payload fields that are the same for every remediation request
+        self._payload_skeleton = {"model": self.model, "stream": True, "options": self._OPTIONS}
+        # monotonic() deadline until which the model is known to be installed
+        self._model_ok_until = 0.0
+    
+    @cached_property
+    def _client(self) -> httpx.AsyncClient:
+        """Shared keep-alive connection pool, created on first use.
+
+        Ollama serves plain HTTP/1.1, so concurrency comes from reusing sockets.
+        """
+        return httpx.AsyncClient(
+            base_url=self.base_url,
+            timeout=self.timeout,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=20, keepalive_expiry=60.0)
+        )
+    
+    async def aclose(self) -> None:
+        """Close the underlying HTTP connection pool if it was ever opened."""
+        client = self.__dict__.pop("_client", None)
+        if client is not None:
+            await client.aclose()
         
     async def generate_remediation(self, system_prompt: str, user_prompt: str, conversation_history: list = None) -> str:
         """
@@ -31,15 +87,10 @@ class OllamaClient:
             The generated code remediation
             
         Raises:
-            Exception: If the request fails or returns invalid response
+            OllamaConnectionError: If the service cannot be reached or times out
+            RuntimeError: If the request fails or returns invalid response
         """
-        url = f"{self.base_url}/api/chat"
-        
-        # Build messages array
-        messages = []
-        
-        # Add system message
-        messages.append({"role": "system", "content": system_prompt})
+        messages = build_messages(system_prompt)
         
         # Add conversation history if provided
         if conversation_history:
@@ -48,82 +99,98 @@ class OllamaClient:
         # Add current user message
         messages.append({"role": "user", "content": user_prompt})
         
-        payload = {
-            "model": self.model,
-            "messages": messages,
-            "stream": False,
-            "options": {
-                "temperature": 0.1,  # Low temperature for more deterministic output
-                "top_p": 0.9,
-                "top_k": 40,
-                "num_predict": 1000,  # Limit response length
-            }
-        }
+        return await self.chat(messages)
+    
+    async def chat(self, messages: list) -> str:
+        """
+        Generate code remediation from an already assembled message list.
         
-        logger.debug(f"Sending chat request to Ollama: {self.base_url}")
-        logger.debug(f"Messages being sent: {len(messages)} total messages")
-        if conversation_history:
-            logger.debug(f"Conversation history includes {len(conversation_history)} previous messages")
-            for i, msg in enumerate(conversation_history):
-                logger.debug(f"  History {i+1}: {msg['role']} - {msg['content'][:100]}...")
+        Args:
+            messages: Chat messages, starting with the system message (see build_messages)
+            
+        Returns:
+            The generated code remediation
+            
+        Raises:
+            OllamaConnectionError: If the service cannot be reached or times out
+            RuntimeError: If the request fails or returns invalid response
+        """
+        payload = {**self._payload_skeleton, "messages": messages}
+        
+        logger.debug("Sending chat request to Ollama: %s", self.base_url)
+        logger.debug("Messages being sent: %d total messages", len(messages))
+        if logger.isEnabledFor(logging.DEBUG):
+            for i, msg in enumerate(messages[1:-1]):
+                logger.debug("  History %d: %s - %s...", i + 1, msg['role'], msg['content'][:100])
         
         try:
-            async with httpx.AsyncClient(timeout=settings.ollama_timeout) as client:
-                response = await client.post(
-                    url,
-                    json=payload,
-                    headers={"Content-Type": "application/json"}
-                )
-                
+            # Ollama streams the completion as NDJSON, one message chunk per line
+            async with self._client.stream(
+                "POST",
+                "/api/chat",
+                content=orjson.dumps(payload),
+                headers={"Content-Type": "application/json"}
+            ) as response:
                 if response.status_code != 200:
+                    await response.aread()
                     error_msg = f"Ollama request failed with status {response.status_code}: {response.text}"
                     logger.error(error_msg)
-                    raise Exception(error_msg)
-                
-                result = response.json()
-                
-                if "message" not in result:
-                    error_msg = f"Invalid response format from Ollama: {result}"
-                    logger.error(error_msg)
-                    raise Exception(error_msg)
-                
-                # Extract content from assistant message
-                assistant_message = result["message"]
-                if assistant_message.get("role") != "assistant":
-                    error_msg = f"Expected assistant role, got: {assistant_message.get('role')}"
-                    logger.error(error_msg)
-                    raise Exception(error_msg)
-                
-                generated_text = assistant_message.get("content", "").strip()
-                
-                # Clean up the response - remove markdown formatting if present
-                generated_text = self._clean_code_response(generated_text)
-                
-                logger.info(f"Generated {len(generated_text)} characters of remediated code")
-                return generated_text
+                    raise RuntimeError(error_msg)
                 
-        except httpx.TimeoutException:
+                content_parts = []
+                async for line in response.aiter_lines():
+                    if not line:
+                        continue
+                    
+                    chunk = orjson.loads(line)
+                    
+                    if "error" in chunk:
+                        error_msg = f"Ollama returned an error: {chunk['error']}"
+                        logger.error(error_msg)
+                        raise RuntimeError(error_msg)
+                    
+                    if "message" not in chunk:
+                        error_msg = f"Invalid response format from Ollama: {chunk}"
+                        logger.error(error_msg)
+                        raise RuntimeError(error_msg)
+                    
+                    # Extract content from assistant message
+                    assistant_message = chunk["message"]
+                    if assistant_message.get("role") != "assistant":
+                        error_msg = f"Expected assistant role, got: {assistant_message.get('role')}"
+                        logger.error(error_msg)
+                        raise RuntimeError(error_msg)
+                    
+                    content_parts.append(assistant_message.get("content", ""))
+                    if chunk.get("done"):
+                        break
+            
+            generated_text = "".join(content_parts).strip()
+            
+            # Clean up the response - remove markdown formatting if present
+            generated_text = self._clean_code_response(generated_text)
+            
+            logger.info("Generated %d characters of remediated code", len(generated_text))
+            return generated_text
+        
+        except httpx.TimeoutException as e:
             error_msg = f"Timeout while communicating with Ollama service at {self.base_url}"
             logger.error(error_msg)
             logger.info("This may indicate the model is not loaded or the request is taking too long")
-            raise Exception(error_msg)
+            raise OllamaConnectionError(error_msg) from e
         except httpx.ConnectError as e:
             error_msg = f"Cannot connect to Ollama service at {self.base_url}"
             logger.error(error_msg)
             logger.info("Make sure Ollama is running locally: ollama serve")
-            raise Exception(error_msg)
+            raise OllamaConnectionError(error_msg) from e
         except httpx.RequestError as e:
             error_msg = f"Network error while communicating with Ollama: {str(e)}"
             logger.error(error_msg)
-            raise Exception(error_msg)
-        except json.JSONDecodeError:
+            raise OllamaConnectionError(error_msg) from e
+        except orjson.JSONDecodeError as e:
             error_msg = "Invalid JSON response from Ollama service"
             logger.error(error_msg)
-            raise Exception(error_msg)
-        except Exception as e:
-            error_msg = f"Ollama client error: {str(e)}"
-            logger.error(error_msg)
-            raise Exception(error_msg)
+            raise RuntimeError(error_msg) from e
     
     def _clean_code_response(self, response: str) -> str:
         """
@@ -135,20 +202,15 @@ class OllamaClient:
         Returns:
             Cleaned code snippet
         """
-        # Remove markdown code blocks if present
-        lines = response.split('\n')
-        cleaned_lines = []
-        in_code_block = False
-        
-        for line in lines:
-            if line.strip().startswith('```'):
-                in_code_block = not in_code_block
-                continue
-            
-            if in_code_block or not any(line.strip().startswith(prefix) for prefix in ['Here', 'This', 'The', 'Note:', 'Remember:', 'Example:']):
-                cleaned_lines.append(line)
+        # Take the fenced code block directly when the model used one
+        match = _FENCE_RE.search(response)
+        if match:
+            fenced_code = match.group(1).strip()
+            if fenced_code:
+                return fenced_code
         
-        cleaned_response = '\n'.join(cleaned_lines).strip()
+        # Otherwise drop stray fence markers and explanatory lines in one pass
+        cleaned_response = _CLEAN_LINE_RE.sub("", response).strip()
         
         # If the response is empty after cleaning, return the original
         if not cleaned_response:
@@ -160,70 +222,104 @@ class OllamaClient:
         """
         Check if the specified model is available in the local Ollama instance.
         
+        A positive result is cached for _MODEL_CHECK_TTL seconds, since the
+        model list only changes when the operator runs ``ollama pull``.
+        
         Returns:
             True if model is available, False otherwise
         """
+        if time.monotonic() < self._model_ok_until:
+            return True
+        
         try:
-            url = f"{self.base_url}/api/tags"
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                response = await client.get(url)
-                if response.status_code == 200:
-                    models_data = response.json()
-                    available_models = [model["name"] for model in models_data.get("models", [])]
-                    model_available = any(self.model in model_name for model_name in available_models)
-                    
-                    if not model_available:
-                        logger.warning(f"Model '{self.model}' not found. Available models: {available_models}")
-                        logger.info(f"To install the model, run: ollama pull {self.model}")
-                    
-                    return model_available
-                return False
+            response = await self._client.get("/api/tags", timeout=10.0)
+            if response.status_code == 200:
+                models_data = orjson.loads(response.content)
+                available_models = [model["name"] for model in models_data.get("models", [])]
+                model_available = any(self.model in model_name for model_name in available_models)
+                
+                if model_available:
+                    self._model_ok_until = time.monotonic() + self._MODEL_CHECK_TTL
+                else:
+                    logger.warning("Model '%s' not found. Available models: %s", self.model, available_models)
+                    logger.info("To install the model, run: ollama pull %s", self.model)
+                
+                return model_available
+            return False
         except Exception as e:
-            logger.warning(f"Failed to check model availability: {e}")
+            logger.warning("Failed to check model availability: %s", e)
             return False
 
-    async def health_check(self) -> bool:
+    async def liveness(self) -> bool:
         """
-        Check if Ollama service is available and model is installed.
+        Check if the Ollama service is running.
         
         Returns:
-            True if service is available, False otherwise
+            True if the service answers, False otherwise
         """
         try:
-            # First check if Ollama service is running
-            url = f"{self.base_url}/api/version"
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                response = await client.get(url)
-                if response.status_code != 200:
-                    logger.warning(f"Ollama service not accessible at {self.base_url}")
-                    logger.info("Make sure Ollama is running locally: ollama serve")
-                    return False
-                
-                logger.debug(f"Ollama service running at {self.base_url}")
-                
-                # Check if model is available
-                model_available = await self.check_model_availability()
-                if not model_available:
-                    logger.warning(f"Model '{self.model}' not available")
-                    return False
-                
-                # Test with a simple chat request
-                chat_url = f"{self.base_url}/api/chat"
-                payload = {
-                    "model": self.model,
-                    "messages": [{"role": "user", "content": "test"}],
-                    "stream": False
-                }
-                
-                response = await client.post(chat_url, json=payload)
-                is_healthy = response.status_code == 200
-                logger.debug(f"Ollama health check: {'healthy' if is_healthy else 'unhealthy'}")
-                return is_healthy
-                
+            response = await self._client.get("/api/version", timeout=10.0)
+            if response.status_code != 200:
+                logger.warning("Ollama service not accessible at %s", self.base_url)
+                logger.info("Make sure Ollama is running locally: ollama serve")
+                return False
+            
+            logger.debug("Ollama service running at %s", self.base_url)
+            return True
+        
         except httpx.ConnectError as e:
-            logger.warning(f"Cannot connect to Ollama at {self.base_url}")
+            logger.warning("Cannot connect to Ollama at %s", self.base_url)
             logger.info("Make sure Ollama is running locally: ollama serve")
             return False
         except Exception as e:
-            logger.warning(f"Ollama health check failed: {e}")
+            logger.warning("Ollama liveness check failed: %s", e)
             return False
+
+    async def readiness(self) -> bool:
+        """
+        Check if Ollama service is available, the model is installed and it answers a chat request.
+        
+        Returns:
+            True if service is ready, False otherwise
+        """
+        if not await self.liveness():
+            return False
+        
+        try:
+            # Check if model is available
+            model_available = await self.check_model_availability()
+            if not model_available:
+                logger.warning("Model '%s' not available", self.model)
+                return False
+            
+            # Test with a simple chat request
+            payload = {
+                "model": self.model,
+                "messages": [{"role": "user", "content": "test"}],
+                "stream": False
+            }
+            
+            response = await self._client.post(
+                "/api/chat",
+                content=orjson.dumps(payload),
+                headers={"Content-Type": "application/json"},
+                timeout=10.0
+            )
+            is_healthy = response.status_code == 200
+            logger.debug("Ollama health check: %s", "healthy" if is_healthy else "unhealthy")
+            return is_healthy
+        
+        except Exception as e:
+            logger.warning("Ollama health check failed: %s", e)
+            return False
+
+    async def health_check(self) -> bool:
+        """
+        Check if Ollama service is available and model is installed.
+        
+        Same as readiness(), kept for existing callers.
+        
+        Returns:
+            True if service is available, False otherwise
+        """
+        return await self.readiness()
@@ -3,24 +3,57 @@
 import asyncio
 import tempfile
 import os
-import json
-import subprocess
-import shlex
-from typing import List, Dict, Any, Optional
+import shutil
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Tuple
 import uuid
 import logging
+import weakref
 
-from ..config.settings import settings
+import orjson
+
+from ..config.settings import get_settings
 from ..models.schemas import VulnerabilityDetail, ScanResult
+from ..utils import get_file_extension
 
 logger = logging.getLogger(__name__)
 
+# VulnerabilityDetail field -> accepted Vorpal result keys (in priority order) and default
+_FIELDS = (
+    ("ruleId", ("rule_id", "ruleId"), 0),
+    ("language", ("language",), "unknown"),
+    ("rule", ("rule_name", "ruleName", "rule"), "Unknown Rule"),
+    ("severity", ("severity",), "medium"),
+    ("file", ("file", "fileName", "filename"), "unknown"),
+    ("line", ("line", "lineNumber", "line_number"), 1),
+    ("content", ("content", "problematic_line", "code"), ""),
+    ("remediationAdvice", ("remediationAdvise", "remediationAadvice", "advice"), ""),
+    ("description", ("description", "desc"), ""),
+)
+
 
 class VorpalScanner:
     """Security scanner using Vorpal CLI tool."""
     
+    # Number of distinct (extension, code) scan results kept in memory
+    _SCAN_CACHE_SIZE = 128
+    # Longest scanner error output kept in a ScanResult
+    _MAX_STDERR_BYTES = 64 * 1024
+    # Vorpal processes run at once by scan_codes
+    _MAX_CONCURRENT_SCANS = 4
+    
     def __init__(self, vorpal_path: Optional[str] = None):
-        self.vorpal_path = vorpal_path or settings.vorpal_path
+        self.vorpal_path = os.fspath(vorpal_path or get_settings().vorpal_path)
+        # Arguments are passed to exec directly (no shell), so the path is used as-is
+        self._cmd_prefix = (self.vorpal_path,)
+        if not (os.path.isfile(self.vorpal_path) and os.access(self.vorpal_path, os.X_OK)):
+            logger.warning(f"Vorpal scanner not found or not executable at {self.vorpal_path}")
+        # Scratch directory reused by every scan of this instance
+        self._scratch_dir = tempfile.mkdtemp(prefix="vorpal-")
+        weakref.finalize(self, shutil.rmtree, self._scratch_dir, ignore_errors=True)
+        # Vorpal has no daemon/batch mode, so identical snippets are answered from
+        # this cache instead of spawning the CLI again
+        self._scan_cache: "OrderedDict[Tuple[str, str], List[VulnerabilityDetail]]" = OrderedDict()
         
     async def scan_code(self, code: str, language: str, filename: str) -> ScanResult:
         """
@@ -37,87 +70,87 @@ class VorpalScanner:
         request_id = str(uuid.uuid4())
         logger.debug(f"Starting scan {request_id} for {language} code")
         
+        extension = self._get_file_extension(language)
+        cache_key = (extension, code)
+        cached = self._scan_cache.get(cache_key)
+        if cached is not None:
+            self._scan_cache.move_to_end(cache_key)
+            logger.info(f"Scan {request_id} served from cache with {len(cached)} vulnerabilities")
+            return ScanResult(
+                request_id=request_id,
+                status=True,
+                message="Scan completed successfully",
+                vulnerabilities=list(cached)
+            )
+        
+        # Vorpal only scans files on disk, so reuse the scanner's scratch directory
+        # and remove just this scan's source and results files afterwards
+        source_file = os.path.join(self._scratch_dir, f"{request_id}.{extension}")
+        result_file = os.path.join(self._scratch_dir, f"{request_id}.json")
+        
         try:
-            # Create temporary file with the code
-            with tempfile.NamedTemporaryFile(
-                mode='w', 
-                suffix=f".{self._get_file_extension(language)}", 
-                delete=False
-            ) as temp_file:
-                temp_file.write(code)
-                temp_file_path = temp_file.name
+            await asyncio.to_thread(self._write_source, source_file, code)
+            
+            # Run Vorpal scanner
+            cmd = (*self._cmd_prefix, "-s", source_file, "-r", result_file)
+            
+            logger.debug(f"Running Vorpal command: {' '.join(cmd)}")
             
+            # Results go to the results file; stdout only carries a banner
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE
+            )
+            
+            # Keep only the head of the error output, but drain the rest so the
+            # scanner never blocks on a full pipe
+            stderr = await self._read_bounded(process.stderr, self._MAX_STDERR_BYTES)
+            await process.wait()
+            
+            # Check if scan completed successfully
+            if process.returncode != 0:
+                error_msg = stderr.decode(errors="replace") if stderr else "Unknown error"
+                logger.warning(f"Vorpal scan failed with code {process.returncode}: {error_msg}")
+                return ScanResult(
+                    request_id=request_id,
+                    status=False,
+                    message=f"Vorpal scan failed: {error_msg}",
+                    vulnerabilities=[],
+                    error=error_msg
+                )
+            
+            # Read results off the event loop if file exists
+            vulnerabilities = []
             try:
-                # Create temporary directory for results
-                with tempfile.TemporaryDirectory() as temp_dir:
-                    result_file = os.path.join(temp_dir, "scan_results.json")
-                    
-                    # Run Vorpal scanner - sanitize vorpal_path to prevent command injection
-                    sanitized_vorpal_path = shlex.quote(self.vorpal_path)
-                    cmd = [
-                        sanitized_vorpal_path,
-                        "-s", temp_file_path,
-                        "-r", result_file
-                    ]
-                    
-                    logger.debug(f"Running Vorpal command: {' '.join(cmd)}")
-                    
-                    process = await asyncio.create_subprocess_exec(
-                        *cmd,
-                        stdout=asyncio.subprocess.PIPE,
-                        stderr=asyncio.subprocess.PIPE
-                    )
-                    
-                    stdout, stderr = await process.communicate()
-                    
-                    # Check if scan completed successfully
-                    if process.returncode != 0:
-                        error_msg = stderr.decode() if stderr else "Unknown error"
-                        logger.warning(f"Vorpal scan failed with code {process.returncode}: {error_msg}")
-                        return ScanResult(
-                            request_id=request_id,
-                            status=False,
-                            message=f"Vorpal scan failed: {error_msg}",
-                            vulnerabilities=[],
-                            error=error_msg
-                        )
-                    
-                    # Read results if file exists
-                    vulnerabilities = []
-                    if os.path.exists(result_file):
-                        try:
-                            with open(result_file, 'r') as f:
-                                content = f.read().strip()
-                                if content:
-                                    results_data = json.loads(content)
-                                    vulnerabilities = self._parse_vorpal_results(results_data)
-                                # Empty file means no vulnerabilities found
-                        except (json.JSONDecodeError, FileNotFoundError) as e:
-                            logger.error(f"Failed to parse scan results: {e}")
-                            return ScanResult(
-                                request_id=request_id,
-                                status=False,
-                                message=f"Failed to parse scan results: {str(e)}",
-                                vulnerabilities=[],
-                                error=str(e)
-                            )
-                    # If no results file exists, assume no vulnerabilities found
-                    
-                    logger.info(f"Scan {request_id} completed with {len(vulnerabilities)} vulnerabilities")
-                    return ScanResult(
-                        request_id=request_id,
-                        status=True,
-                        message="Scan completed successfully",
-                        vulnerabilities=vulnerabilities
-                    )
-                    
-            finally:
-                # Clean up temporary file
-                try:
-                    os.unlink(temp_file_path)
-                except OSError:
-                    pass
-                    
+                content = await asyncio.to_thread(self._read_results, result_file)
+                if content:
+                    results_data = orjson.loads(content)
+                    vulnerabilities = self._parse_vorpal_results(results_data)
+                # Empty file means no vulnerabilities found
+            except (orjson.JSONDecodeError, FileNotFoundError) as e:
+                logger.error(f"Failed to parse scan results: {e}")
+                return ScanResult(
+                    request_id=request_id,
+                    status=False,
+                    message=f"Failed to parse scan results: {str(e)}",
+                    vulnerabilities=[],
+                    error=str(e)
+                )
+            # If no results file exists, assume no vulnerabilities found
+            
+            self._scan_cache[cache_key] = vulnerabilities
+            if len(self._scan_cache) > self._SCAN_CACHE_SIZE:
+                self._scan_cache.popitem(last=False)
+            
+            logger.info(f"Scan {request_id} completed with {len(vulnerabilities)} vulnerabilities")
+            return ScanResult(
+                request_id=request_id,
+                status=True,
+                message="Scan completed successfully",
+                vulnerabilities=list(vulnerabilities)
+            )
+            
         except Exception as e:
             logger.error(f"Scan {request_id} failed: {e}")
             return ScanResult(
@@ -127,6 +160,75 @@ class VorpalScanner:
                 vulnerabilities=[],
                 error=str(e)
             )
+            
+        finally:
+            # Clean up this scan's files, keeping the scratch directory
+            await asyncio.to_thread(self._remove_files, source_file, result_file)
+    
+    async def scan_codes(self, items: List[Tuple[str, str, str]]) -> List[ScanResult]:
+        """
+        Scan several code samples for security vulnerabilities.
+        
+        Vorpal scans a single file per invocation, so distinct samples are
+        scanned concurrently (up to _MAX_CONCURRENT_SCANS processes at once),
+        and repeated samples wait for the first scan and are served from the cache.
+        
+        Args:
+            items: (code, language, filename) tuples, as passed to scan_code
+            
+        Returns:
+            ScanResult for each item, in the same order
+        """
+        semaphore = asyncio.Semaphore(self._MAX_CONCURRENT_SCANS)
+        first_scans: Dict[Tuple[str, str], asyncio.Future] = {}
+        
+        async def bounded_scan(code: str, language: str, filename: str) -> ScanResult:
+            async with semaphore:
+                return await self.scan_code(code, language, filename)
+        
+        async def scan_item(code: str, language: str, filename: str) -> ScanResult:
+            cache_key = (self._get_file_extension(language), code)
+            first_scan = first_scans.get(cache_key)
+            if first_scan is None:
+                first_scan = first_scans[cache_key] = asyncio.ensure_future(bounded_scan(code, language, filename))
+                return await first_scan
+            await first_scan
+            return await bounded_scan(code, language, filename)
+        
+        return list(await asyncio.gather(*(scan_item(*item) for item in items)))
+    
+    @staticmethod
+    def _write_source(path: str, code: str) -> None:
+        """Write the code to scan to disk, recreating the scratch directory if it was removed."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(code)
+    
+    @staticmethod
+    async def _read_bounded(stream: asyncio.StreamReader, limit: int) -> bytes:
+        """Read a stream to EOF, keeping at most ``limit`` bytes of it."""
+        head = bytearray()
+        while chunk := await stream.read(64 * 1024):
+            if len(head) < limit:
+                head += chunk[:limit - len(head)]
+        return bytes(head)
+    
+    @staticmethod
+    def _read_results(path: str) -> bytes:
+        """Read the raw scan results, or b"" if no results file was written."""
+        if not os.path.exists(path):
+            return b""
+        with open(path, 'rb') as f:
+            return f.read().strip()
+    
+    @staticmethod
+    def _remove_files(*paths: str) -> None:
+        """Remove per-scan files, ignoring ones that were never created."""
+        for path in paths:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
     
     def _parse_vorpal_results(self, results_data: Dict[str, Any]) -> List[VulnerabilityDetail]:
         """
@@ -165,17 +267,11 @@ class VorpalScanner:
             
             for result in scan_results:
                 if isinstance(result, dict):
-                    vuln = VulnerabilityDetail(
-                        ruleId=result.get("rule_id", result.get("ruleId", 0)),
-                        language=result.get("language", "unknown"),
-                        rule=result.get("rule_name", result.get("ruleName", result.get("rule", "Unknown Rule"))),
-                        severity=result.get("severity", "medium"),
-                        file=result.get("file", result.get("fileName", result.get("filename", "unknown"))),
-                        line=result.get("line", result.get("lineNumber", result.get("line_number", 1))),
-                        content=result.get("content", result.get("problematic_line", result.get("code", ""))),
-                        remediationAdvice=result.get("remediationAdvise", result.get("remediationAadvice", result.get("advice", ""))),
-                        description=result.get("description", result.get("desc", ""))
-                    )
+                    fields = {
+                        name: next((result[key] for key in keys if key in result), default)
+                        for name, keys, default in _FIELDS
+                    }
+                    vuln = VulnerabilityDetail(**fields)
                     vulnerabilities.append(vuln)
                     
         except Exception as e:
@@ -195,17 +291,8 @@ class VorpalScanner:
         
         return vulnerabilities
     
-    def _get_file_extension(self, language: str) -> str:
-        """Get appropriate file extension for the language."""
-        extensions = {
-            "python": "py",
-            "javascript": "js",
-            "java": "java",
-            "go": "go",
-            "csharp": "cs",
-            "c#": "cs"
-        }
-        return extensions.get(language.lower(), "txt")
+    # Get appropriate file extension for the language (shared cached dict lookup)
+    _get_file_extension = staticmethod(get_file_extension)
     
     async def health_check(self) -> bool:
         """
@@ -215,16 +302,15 @@ class VorpalScanner:
             True if scanner is available, False otherwise
         """
         try:
-            # Test with a simple command - sanitize vorpal_path to prevent command injection
-            sanitized_vorpal_path = shlex.quote(self.vorpal_path)
+            # Test with a simple command
             process = await asyncio.create_subprocess_exec(
-                sanitized_vorpal_path,
+                *self._cmd_prefix,
                 "-v",
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL
             )
             
-            stdout, stderr = await process.communicate()
+            await process.wait()
             is_healthy = process.returncode == 1  # Vorpal returns 1 for version command
             logger.debug(f"Vorpal health check: {'healthy' if is_healthy else 'unhealthy'}")
             return is_healthy
@@ -0,0 +1,20 @@
+"""Shared helper utilities"""
+
+from functools import lru_cache
+from typing import Dict, Final
+
+# File extensions used when writing code for each supported language
+_EXT: Final[Dict[str, str]] = {
+    "python": "py",
+    "javascript": "js",
+    "java": "java",
+    "go": "go",
+    "csharp": "cs",
+    "c#": "cs",
+}
+
+
+@lru_cache(maxsize=32)
+def get_file_extension(language: str) -> str:
+    """Get appropriate file extension for the language."""
+    return _EXT.get(language.lower(), "txt")
@@ -1,87 +1,184 @@
 """Pytest configuration and fixtures"""
 
+import httpx
+import orjson
 import pytest
-import asyncio
-from typing import Generator, AsyncGenerator
-from unittest.mock import AsyncMock, Mock
+import pytest_asyncio
+from collections import deque
+from typing import AsyncGenerator
 
+from fastapi import FastAPI
 from fastapi.testclient import TestClient
 
-from src.remediation.main import create_app
-from src.remediation.services.ollama_client import OllamaClient
-from src.remediation.services.vorpal_scanner import VorpalScanner
+from src.remediation.api.routes import get_ollama_client, get_vorpal_scanner
+from src.remediation.main import app as _module_app
 from src.remediation.models.schemas import ScanResult, VulnerabilityDetail
 
 
+class _StubOllama:
+    """Stand-in for OllamaClient implementing only the calls the routes make."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        """Restore the default, healthy behaviour."""
+        # Returned from chat(), or raised if it is an exception
+        self.response = "secure_code_example"
+        # Responses handed out one per call before falling back to response
+        self.responses: deque = deque()
+        # Snapshot of the messages sent on each chat() call
+        self.chat_calls: list = []
+        self.live = True
+        self.ready = True
+        self.readiness_calls = 0
+
+    async def chat(self, messages: list) -> str:
+        # The route reuses one list across attempts, so record a copy
+        self.chat_calls.append(list(messages))
+        response = self.responses.popleft() if self.responses else self.response
+        if isinstance(response, BaseException):
+            raise response
+        return response
+
+    async def liveness(self) -> bool:
+        return self.live
+
+    async def readiness(self) -> bool:
+        self.readiness_calls += 1
+        return self.ready
+
+    async def health_check(self) -> bool:
+        return await self.readiness()
+
+
+class _StubVorpal:
+    """Stand-in for VorpalScanner implementing only the calls the routes make."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        """Restore the default, healthy behaviour."""
+        self.healthy = True
+        self.health_checks = 0
+        # Default to no vulnerabilities found
+        self.scan_result = ScanResult(
+            request_id="test-123",
+            status=True,
+            message="Scan completed successfully",
+            vulnerabilities=[]
+        )
+        # Results handed out one per scan before falling back to scan_result
+        self.scan_results: deque = deque()
+
+    async def scan_code(self, code: str, language: str, filename: str) -> ScanResult:
+        if self.scan_results:
+            return self.scan_results.popleft()
+        return self.scan_result
+
+    async def health_check(self) -> bool:
+        self.health_checks += 1
+        return self.healthy
+
+
 @pytest.fixture(scope="session")
-def event_loop() -> Generator[asyncio.AbstractEventLoop, None, None]:
-    """Create an instance of the default event loop for the test session."""
-    loop = asyncio.get_event_loop_policy().new_event_loop()
-    yield loop
-    loop.close()
+def mock_ollama_client() -> _StubOllama:
+    """Create a stub Ollama client."""
+    return _StubOllama()
 
 
-@pytest.fixture
-def client() -> TestClient:
-    """Create a test client for the FastAPI app."""
-    app = create_app()
+@pytest.fixture(scope="session")
+def mock_vorpal_scanner() -> _StubVorpal:
+    """Create a stub Vorpal scanner."""
+    return _StubVorpal()
+
+
+@pytest.fixture(scope="session")
+def app(mock_ollama_client: _StubOllama, mock_vorpal_scanner: _StubVorpal) -> FastAPI:
+    """The module-level FastAPI app with its service dependencies resolved to the shared stubs."""
+    # Importing main already built the app; reuse it rather than building a second one
+    app = _module_app
+    app.dependency_overrides[get_ollama_client] = lambda: mock_ollama_client
+    app.dependency_overrides[get_vorpal_scanner] = lambda: mock_vorpal_scanner
+    return app
+
+
+@pytest.fixture(scope="session")
+def client(app: FastAPI) -> TestClient:
+    """Create a sync test client, used to exercise the app lifespan."""
     return TestClient(app)
 
 
-@pytest.fixture
-def mock_ollama_client() -> Mock:
-    """Create a mock Ollama client."""
-    mock = AsyncMock(spec=OllamaClient)
-    mock.health_check.return_value = True
-    mock.generate_remediation.return_value = "secure_code_example"
-    return mock
+@pytest_asyncio.fixture
+async def async_client(app: FastAPI) -> AsyncGenerator[httpx.AsyncClient, None]:
+    """Create an async client that calls the app in-process over ASGI."""
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as async_client:
+        yield async_client
 
 
-@pytest.fixture
-def mock_vorpal_scanner() -> Mock:
-    """Create a mock Vorpal scanner."""
-    mock = AsyncMock(spec=VorpalScanner)
-    mock.health_check.return_value = True
-    
-    # Default to no vulnerabilities found
-    mock.scan_code.return_value = ScanResult(
-        request_id="test-123",
-        status=True,
-        message="Scan completed successfully",
-        vulnerabilities=[]
+@pytest.fixture(autouse=True)
+def _reset_service_stubs(mock_ollama_client: _StubOllama, mock_vorpal_scanner: _StubVorpal):
+    """Restore the shared service stubs to their defaults after each test."""
+    yield
+    mock_ollama_client.reset()
+    mock_vorpal_scanner.reset()
+
+
+@pytest.fixture(scope="session")
+def sample_vuln_dict() -> dict:
+    """Sample vulnerability entry as written by the Vorpal scanner."""
+    return {
+        "ruleId": 1,
+        "language": "python",
+        "ruleName": "SQL Injection",
+        "severity": "high",
+        "fileName": "test.py",
+        "line": 5,
+        "content": "query = 'SELECT * FROM users WHERE id = ' + user_id",
+        "remediationAdvise": "Use parameterized queries",
+        "description": "SQL injection vulnerability"
+    }
+
+
+@pytest.fixture(scope="session")
+def sample_vuln_model(sample_vuln_dict: dict) -> VulnerabilityDetail:
+    """The sample vulnerability as parsed into a VulnerabilityDetail."""
+    return VulnerabilityDetail(
+        ruleId=sample_vuln_dict["ruleId"],
+        language=sample_vuln_dict["language"],
+        rule=sample_vuln_dict["ruleName"],
+        severity=sample_vuln_dict["severity"],
+        file=sample_vuln_dict["fileName"],
+        line=sample_vuln_dict["line"],
+        content=sample_vuln_dict["content"],
+        remediationAdvice=sample_vuln_dict["remediationAdvise"],
+        description=sample_vuln_dict["description"]
     )
-    return mock
+
+
+@pytest.fixture(scope="session")
+def sample_vuln_json(sample_vuln_dict: dict) -> bytes:
+    """The sample vulnerability serialized as a Vorpal results file, encoded once per session."""
+    return orjson.dumps({"results": [sample_vuln_dict]})
 
 
 @pytest.fixture
-def mock_vorpal_scanner_with_vulnerabilities() -> Mock:
-    """Create a mock Vorpal scanner that finds vulnerabilities."""
-    mock = AsyncMock(spec=VorpalScanner)
-    mock.health_check.return_value = True
-    
-    vulnerability = VulnerabilityDetail(
-        rule_id=1,
-        language="python",
-        rule_name="SQL Injection",
-        severity="high",
-        file_name="test.py",
-        line=1,
-        length=10,
-        problematic_line="query = 'SELECT * FROM users WHERE id = ' + user_id",
-        remediation_advise="Use parameterized queries",
-        description="SQL injection vulnerability"
-    )
-    
-    mock.scan_code.return_value = ScanResult(
+def mock_vorpal_scanner_with_vulnerabilities(
+    mock_vorpal_scanner: _StubVorpal,
+    sample_vuln_model: VulnerabilityDetail
+) -> _StubVorpal:
+    """Configure the shared stub Vorpal scanner to find vulnerabilities."""
+    mock_vorpal_scanner.scan_result = ScanResult(
         request_id="test-123",
         status=True,
         message="Scan completed successfully",
-        vulnerabilities=[vulnerability]
+        vulnerabilities=[sample_vuln_model]
     )
-    return mock
+    return mock_vorpal_scanner
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def sample_remediation_request() -> dict:
     """Sample remediation request data."""
     return {
@@ -92,7 +189,7 @@ def sample_remediation_request() -> dict:
     }
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def sample_go_request() -> dict:
     """Sample Go remediation request data."""
     return {
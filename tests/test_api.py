@@ -1,58 +1,85 @@
 """Test cases for API endpoints"""
 
+import logging
+import os
+import time
+from logging.handlers import QueueHandler
+
+import httpx
+import orjson
 import pytest
-from unittest.mock import patch, AsyncMock
+from fastapi.middleware.cors import CORSMiddleware
 from fastapi.testclient import TestClient
 
-from src.remediation.models.schemas import ScanResult, VulnerabilityDetail
+from src.remediation.config.settings import settings
+from src.remediation.main import configure_logging, create_app
+from src.remediation.models.schemas import ScanResult
+from src.remediation.services.ollama_client import OllamaConnectionError
+
+
+def _json(response: httpx.Response):
+    """Decode a JSON response body with orjson."""
+    return orjson.loads(response.content)
 
 
 class TestRemediationAPI:
     """Test cases for the remediation API endpoint"""
 
-    def test_health_endpoint(self, client: TestClient):
-        """Test the health check endpoint"""
-        response = client.get("/health")
+    def test_app_lifespan_startup(self, client: TestClient):
+        """Test the app serves requests through its startup/shutdown lifespan"""
+        with client:
+            response = client.get("/health")
         assert response.status_code == 200
-        assert response.json() == {"status": "healthy"}
+        assert _json(response) == {"status": "healthy"}
 
-    @patch("src.remediation.api.routes.get_ollama_client")
-    @patch("src.remediation.api.routes.get_vorpal_scanner")
-    def test_successful_remediation(
+    def test_lifespan_logs_reach_log_file(self, client: TestClient):
+        """Test records logged during the lifespan are written by the single queue listener"""
+        listener = configure_logging()
+        assert configure_logging() is listener
+        assert sum(isinstance(h, QueueHandler) for h in logging.getLogger().handlers) == 1
+        
+        log_file = next(h for h in listener.handlers if isinstance(h, logging.FileHandler)).baseFilename
+        offset = os.path.getsize(log_file)
+        with client:
+            pass
+        
+        # The listener writes from its own thread, so wait for the shutdown record to land
+        deadline = time.monotonic() + 5
+        written = ""
+        while "Shutting down Code Remediation Service" not in written and time.monotonic() < deadline:
+            time.sleep(0.01)
+            with open(log_file) as f:
+                f.seek(offset)
+                written = f.read()
+        assert f"Starting {settings.app_name}" in written
+        assert "Shutting down Code Remediation Service" in written
+
+    @pytest.mark.asyncio
+    async def test_successful_remediation(
         self, 
-        mock_get_scanner, 
-        mock_get_ollama, 
-        client: TestClient,
+        async_client: httpx.AsyncClient,
         mock_ollama_client,
         mock_vorpal_scanner,
         sample_remediation_request
     ):
         """Test successful code remediation"""
-        mock_get_ollama.return_value = mock_ollama_client
-        mock_get_scanner.return_value = mock_vorpal_scanner
-        
-        response = client.post("/api/remediation", json=sample_remediation_request)
+        response = await async_client.post("/api/remediation", json=sample_remediation_request)
         
         assert response.status_code == 200
-        data = response.json()
+        data = _json(response)
         assert "remediated_code" in data
         assert data["remediated_code"] == "secure_code_example"
 
-    @patch("src.remediation.api.routes.get_ollama_client")
-    @patch("src.remediation.api.routes.get_vorpal_scanner")
-    def test_remediation_with_retries(
+    @pytest.mark.asyncio
+    async def test_remediation_with_retries(
         self,
-        mock_get_scanner,
-        mock_get_ollama,
-        client: TestClient,
+        async_client: httpx.AsyncClient,
         mock_ollama_client,
         mock_vorpal_scanner_with_vulnerabilities,
+        sample_vuln_model,
         sample_remediation_request
     ):
         """Test remediation that requires retries due to vulnerabilities"""
-        mock_get_ollama.return_value = mock_ollama_client
-        mock_get_scanner.return_value = mock_vorpal_scanner_with_vulnerabilities
-        
         # Configure scanner to return vulnerabilities first, then clean on retry
         scan_results = [
             # First scan - with vulnerabilities
@@ -60,18 +87,7 @@ class TestRemediationAPI:
                 request_id="test-1",
                 status=True,
                 message="Scan completed",
-                vulnerabilities=[VulnerabilityDetail(
-                    rule_id=1,
-                    language="python",
-                    rule_name="SQL Injection",
-                    severity="high",
-                    file_name="test.py",
-                    line=1,
-                    length=10,
-                    problematic_line="bad code",
-                    remediation_advise="fix it",
-                    description="vulnerability found"
-                )]
+                vulnerabilities=[sample_vuln_model]
             ),
             # Second scan - clean
             ScanResult(
@@ -82,37 +98,32 @@ class TestRemediationAPI:
             )
         ]
         
-        mock_vorpal_scanner_with_vulnerabilities.scan_code.side_effect = scan_results
+        mock_vorpal_scanner_with_vulnerabilities.scan_results.extend(scan_results)
         
-        response = client.post("/api/remediation", json=sample_remediation_request)
+        response = await async_client.post("/api/remediation", json=sample_remediation_request)
         
         assert response.status_code == 200
-        data = response.json()
+        data = _json(response)
         assert "remediated_code" in data
 
-    @patch("src.remediation.api.routes.get_ollama_client")
-    @patch("src.remediation.api.routes.get_vorpal_scanner")
-    def test_max_retries_exceeded(
+    @pytest.mark.asyncio
+    async def test_max_retries_exceeded(
         self,
-        mock_get_scanner,
-        mock_get_ollama,
-        client: TestClient,
+        async_client: httpx.AsyncClient,
         mock_ollama_client,
         mock_vorpal_scanner_with_vulnerabilities,
         sample_remediation_request
     ):
         """Test when max retries are exceeded"""
-        mock_get_ollama.return_value = mock_ollama_client
-        mock_get_scanner.return_value = mock_vorpal_scanner_with_vulnerabilities
-        
-        response = client.post("/api/remediation", json=sample_remediation_request)
+        response = await async_client.post("/api/remediation", json=sample_remediation_request)
         
         assert response.status_code == 422
-        data = response.json()
+        data = _json(response)
         assert "detail" in data
         assert "Unable to generate secure code after 5 attempts" in data["detail"]
 
-    def test_invalid_language(self, client: TestClient):
+    @pytest.mark.asyncio
+    async def test_invalid_language(self, async_client: httpx.AsyncClient):
         """Test with unsupported language"""
         request_data = {
             "language": "cobol",
@@ -121,110 +132,220 @@ class TestRemediationAPI:
             "remediationAdvice": "Some advice"
         }
         
-        response = client.post("/api/remediation", json=request_data)
+        response = await async_client.post("/api/remediation", json=request_data)
         
         assert response.status_code == 400
-        data = response.json()
+        data = _json(response)
         assert "Unsupported language" in data["detail"]
 
-    def test_missing_required_fields(self, client: TestClient):
+    @pytest.mark.asyncio
+    async def test_missing_required_fields(self, async_client: httpx.AsyncClient):
         """Test with missing required fields"""
         request_data = {
             "language": "python"
             # Missing other required fields
         }
         
-        response = client.post("/api/remediation", json=request_data)
+        response = await async_client.post("/api/remediation", json=request_data)
         
         assert response.status_code == 422
 
-    @patch("src.remediation.api.routes.get_ollama_client")
-    @patch("src.remediation.api.routes.get_vorpal_scanner")
-    def test_ollama_service_error(
+    @pytest.mark.asyncio
+    async def test_ollama_service_error(
         self,
-        mock_get_scanner,
-        mock_get_ollama,
-        client: TestClient,
+        async_client: httpx.AsyncClient,
+        mock_ollama_client,
         mock_vorpal_scanner,
         sample_remediation_request
     ):
         """Test when Ollama service fails"""
-        mock_ollama_client = AsyncMock()
-        mock_ollama_client.generate_remediation.side_effect = Exception("Ollama error")
-        
-        mock_get_ollama.return_value = mock_ollama_client
-        mock_get_scanner.return_value = mock_vorpal_scanner
+        mock_ollama_client.response = Exception("Ollama error")
         
-        response = client.post("/api/remediation", json=sample_remediation_request)
+        response = await async_client.post("/api/remediation", json=sample_remediation_request)
         
         assert response.status_code == 500
+        # Only connection failures are retried
+        assert len(mock_ollama_client.chat_calls) == 1
 
-    @patch("src.remediation.api.routes.get_ollama_client")
-    @patch("src.remediation.api.routes.get_vorpal_scanner")
-    def test_empty_ollama_response(
+    @pytest.mark.asyncio
+    async def test_transient_ollama_error_is_retried(
         self,
-        mock_get_scanner,
-        mock_get_ollama,
-        client: TestClient,
+        async_client: httpx.AsyncClient,
+        mock_ollama_client,
         mock_vorpal_scanner,
         sample_remediation_request
     ):
-        """Test when Ollama returns empty response"""
-        mock_ollama_client = AsyncMock()
-        mock_ollama_client.generate_remediation.return_value = ""
+        """Test a connection failure is retried with the original prompt"""
+        mock_ollama_client.responses.extend([OllamaConnectionError("timed out"), "secure_code_example"])
+        
+        response = await async_client.post("/api/remediation", json=sample_remediation_request)
+        
+        assert response.status_code == 200
+        assert _json(response)["remediated_code"] == "secure_code_example"
+        first, retry = mock_ollama_client.chat_calls
+        assert retry == first
+        assert [message["role"] for message in retry] == ["system", "user"]
+        assert sample_remediation_request["ruleName"] in retry[-1]["content"]
+
+    @pytest.mark.asyncio
+    async def test_retry_history_is_capped(
+        self,
+        async_client: httpx.AsyncClient,
+        mock_ollama_client,
+        mock_vorpal_scanner_with_vulnerabilities,
+        sample_remediation_request
+    ):
+        """Test retries only resend the most recent attempts"""
+        response = await async_client.post("/api/remediation", json=sample_remediation_request)
         
-        mock_get_ollama.return_value = mock_ollama_client
-        mock_get_scanner.return_value = mock_vorpal_scanner
+        assert response.status_code == 422
+        calls = mock_ollama_client.chat_calls
+        assert len(calls) == settings.max_retries
+        # System prompt, at most max_history_messages of history, then the prompt
+        assert max(len(messages) for messages in calls) == 1 + settings.max_history_messages + 1
+        assert all(messages[0]["role"] == "system" for messages in calls)
+
+    @pytest.mark.asyncio
+    async def test_retry_messages_per_attempt(
+        self,
+        async_client: httpx.AsyncClient,
+        mock_ollama_client,
+        mock_vorpal_scanner_with_vulnerabilities,
+        sample_remediation_request
+    ):
+        """Test the conversation sent on each attempt of the rolling retry loop"""
+        mock_ollama_client.responses.extend(f"code-{n}" for n in range(1, settings.max_retries + 1))
+        
+        response = await async_client.post("/api/remediation", json=sample_remediation_request)
+        
+        assert response.status_code == 422
+        calls = mock_ollama_client.chat_calls
+        feedback = ["assistant", "vorpal_results"]
+        assert [[message["role"] for message in messages] for messages in calls] == [
+            ["system", "user"],
+            ["system", *feedback, "user"],
+            ["system", *feedback, *feedback, "user"],
+            ["system", *feedback, *feedback, "user"],
+            ["system", *feedback, *feedback, "user"],
+        ]
+        # Only the first attempt sends the original prompt; retries send the retry prompt
+        assert sample_remediation_request["ruleName"] in calls[0][-1]["content"]
+        assert all(messages[-1]["content"] == calls[1][-1]["content"] for messages in calls[1:])
+        assert calls[1][-1]["content"] != calls[0][-1]["content"]
+        # The oldest attempt is dropped first
+        assert [m["content"] for m in calls[-1] if m["role"] == "assistant"] == ["code-3", "code-4"]
+
+    @pytest.mark.asyncio
+    async def test_empty_ollama_response(
+        self,
+        async_client: httpx.AsyncClient,
+        mock_ollama_client,
+        mock_vorpal_scanner,
+        sample_remediation_request
+    ):
+        """Test when Ollama returns empty response"""
+        mock_ollama_client.response = ""
         
-        response = client.post("/api/remediation", json=sample_remediation_request)
+        response = await async_client.post("/api/remediation", json=sample_remediation_request)
         
         assert response.status_code == 500
-        data = response.json()
+        data = _json(response)
         assert "Empty response from AI model" in data["detail"]
 
 
 class TestHealthAPI:
     """Test cases for health check endpoint"""
 
-    @patch("src.remediation.api.routes.get_ollama_client")
-    @patch("src.remediation.api.routes.get_vorpal_scanner")
-    def test_health_check_success(
+    @pytest.mark.asyncio
+    async def test_health_check_success(
         self,
-        mock_get_scanner,
-        mock_get_ollama,
-        client: TestClient,
+        async_client: httpx.AsyncClient,
         mock_ollama_client,
         mock_vorpal_scanner
     ):
         """Test successful health check"""
-        mock_get_ollama.return_value = mock_ollama_client
-        mock_get_scanner.return_value = mock_vorpal_scanner
-        
-        response = client.get("/health")
+        response = await async_client.get("/health")
         
         assert response.status_code == 200
-        assert response.json() == {"status": "healthy"}
+        assert _json(response) == {"status": "healthy"}
+        assert mock_vorpal_scanner.health_checks == 0
 
-    @patch("src.remediation.api.routes.get_ollama_client")
-    @patch("src.remediation.api.routes.get_vorpal_scanner")
-    def test_health_check_with_service_errors(
+    @pytest.mark.asyncio
+    async def test_health_check_with_service_errors(
         self,
-        mock_get_scanner,
-        mock_get_ollama,
-        client: TestClient
+        async_client: httpx.AsyncClient,
+        mock_ollama_client,
+        mock_vorpal_scanner
     ):
         """Test health check when services have issues"""
-        mock_ollama = AsyncMock()
-        mock_ollama.health_check.return_value = False
+        mock_ollama_client.live = False
+        mock_vorpal_scanner.healthy = False
         
-        mock_scanner = AsyncMock()
-        mock_scanner.health_check.return_value = False
-        
-        mock_get_ollama.return_value = mock_ollama
-        mock_get_scanner.return_value = mock_scanner
-        
-        response = client.get("/health")
+        response = await async_client.get("/health")
         
         # Service should still be healthy even if dependencies are down
         assert response.status_code == 200
-        assert response.json() == {"status": "healthy"}
+        assert _json(response) == {"status": "healthy"}
+
+    @pytest.mark.asyncio
+    async def test_readiness_check_ready(
+        self,
+        async_client: httpx.AsyncClient,
+        mock_ollama_client,
+        mock_vorpal_scanner
+    ):
+        """Test readiness when both dependencies are ready"""
+        response = await async_client.get("/health/ready")
+        
+        assert response.status_code == 200
+        assert _json(response) == {"status": "ready"}
+        assert mock_ollama_client.readiness_calls == 1
+
+    @pytest.mark.asyncio
+    async def test_readiness_check_not_ready(
+        self,
+        async_client: httpx.AsyncClient,
+        mock_ollama_client,
+        mock_vorpal_scanner
+    ):
+        """Test readiness fails while the model is not available"""
+        mock_ollama_client.ready = False
+        response = await async_client.get("/health/ready")
+        
+        assert response.status_code == 503
+        assert _json(response)["detail"] == "Service not ready"
+
+
+class TestCORS:
+    """Test cases for the optional CORS middleware"""
+
+    _ORIGIN = "https://app.example.com"
+
+    def _preflight(self, method: str, headers: str) -> dict:
+        return {
+            "Origin": self._ORIGIN,
+            "Access-Control-Request-Method": method,
+            "Access-Control-Request-Headers": headers,
+        }
+
+    def test_cors_disabled_by_default(self):
+        """Test no CORS middleware is installed without configured origins"""
+        app = create_app()
+        assert not any(middleware.cls is CORSMiddleware for middleware in app.user_middleware)
+
+    @pytest.mark.asyncio
+    async def test_cors_preflight_with_configured_origins(self, monkeypatch):
+        """Test preflights are limited to the configured origins, methods and headers"""
+        monkeypatch.setattr(settings, "cors_origins", [self._ORIGIN])
+        app = create_app()
+        
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as cors_client:
+            allowed = await cors_client.options("/api/remediation", headers=self._preflight("POST", "content-type"))
+            bad_method = await cors_client.options("/api/remediation", headers=self._preflight("DELETE", "content-type"))
+            bad_header = await cors_client.options("/api/remediation", headers=self._preflight("POST", "x-api-key"))
+        
+        assert allowed.status_code == 200
+        assert allowed.headers["access-control-allow-origin"] == self._ORIGIN
+        assert bad_method.status_code == 400
+        assert bad_header.status_code == 400
+